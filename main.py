@@ -1,3 +1,5 @@
+import asyncio
+
 from astrbot.api import logger
 from astrbot.api.star import Context, Star
 from astrbot.core import AstrBotConfig
@@ -5,18 +7,34 @@ from astrbot.core import AstrBotConfig
 # 硬编码provider类型名
 LOAD_BALANCER_PROVIDER_TYPE_NAME = "load_balancer_chat_completion"
 PROVIDER_MANAGER = None
+# provider变化后刷新负载均衡配置的合并窗口（秒）
+UPDATE_DEBOUNCE_DELAY = 0.1
+# 延迟导入的CONFIG_METADATA_2缓存
+_CM2 = None
+
+
+def _config_metadata():
+    """首次使用时导入并缓存CONFIG_METADATA_2"""
+    global _CM2
+    if _CM2 is None:
+        from astrbot.core.config.default import CONFIG_METADATA_2 as _CM2
+    return _CM2
 
 
 class LBProviderPlugin(Star):
 
-    def __init__(self, context: Context, config: AstrBotConfig ):
+    def __init__(self, context: Context, config: AstrBotConfig | None = None):
         super().__init__(context)
         self.context = context
         self.provider_manager = context.provider_manager
         self.original_load_provider = self.provider_manager.load_provider
         self.original_reload = self.provider_manager.reload
         self.original_terminate_provider = self.provider_manager.terminate_provider
-        self.lb_provider_node_total = config.get("lb_provider_node_total", 5)
+        self.lb_provider_node_total = (config or {}).get("lb_provider_node_total", 5)
+        self._pending_update: asyncio.TimerHandle | None = None
+        self._hooks_installed = False
+        # 上次注入配置元数据时的节点数量，未变化时跳过重建
+        self._injected_node_total: int | None = None
         global PROVIDER_MANAGER
         PROVIDER_MANAGER = context.provider_manager
 
@@ -38,11 +56,18 @@ class LBProviderPlugin(Star):
         try:
             from .provider import load_balancer_provider
             self.update_lb_provider()
+            self._setup_hooks()
         except ImportError as e:
             logger.error(f"导入 {LOAD_BALANCER_PROVIDER_TYPE_NAME} 失败，请检查依赖是否安装: {e}")
             raise
 
     async def terminate(self):
+        # 取消待执行的配置刷新并恢复原始方法
+        if self._pending_update is not None:
+            self._pending_update.cancel()
+            self._pending_update = None
+        self._revoke_hooks()
+
         # 在插件终止时卸载相关的provider
         for p in self.context.get_all_providers():  # 获取所有chat completion providers
             pm = p.meta()
@@ -52,6 +77,45 @@ class LBProviderPlugin(Star):
         # 删除动态注入的配置
         self.remove_dynamic_config()
 
+    def _setup_hooks(self):
+        """挂载provider加载/终止钩子，provider变化时刷新负载均衡配置"""
+        # 避免重复挂载导致钩子层层嵌套
+        if self._hooks_installed:
+            return
+
+        async def hooked_load_provider(*args, **kwargs):
+            result = await self.original_load_provider(*args, **kwargs)
+            self._schedule_update()
+            return result
+
+        async def hooked_terminate_provider(*args, **kwargs):
+            result = await self.original_terminate_provider(*args, **kwargs)
+            self._schedule_update()
+            return result
+
+        self.provider_manager.load_provider = hooked_load_provider
+        self.provider_manager.terminate_provider = hooked_terminate_provider
+        self._hooks_installed = True
+
+    def _revoke_hooks(self):
+        """恢复provider_manager的原始方法"""
+        if not self._hooks_installed:
+            return
+        self.provider_manager.load_provider = self.original_load_provider
+        self.provider_manager.terminate_provider = self.original_terminate_provider
+        self._hooks_installed = False
+
+    def _schedule_update(self):
+        """合并短时间内的多次刷新请求，批量加载provider时只刷新一次"""
+        if self._pending_update is not None:
+            self._pending_update.cancel()
+        loop = asyncio.get_running_loop()
+        self._pending_update = loop.call_later(UPDATE_DEBOUNCE_DELAY, self._run_pending_update)
+
+    def _run_pending_update(self):
+        self._pending_update = None
+        self.update_lb_provider()
+
     def update_lb_provider(self):
         self.inject_provider_metadata()
         self.check_provider_config()
@@ -61,13 +125,16 @@ class LBProviderPlugin(Star):
         lb_providers = []
         worker_provider_ids = set()
         for p in self.provider_manager.get_insts():
-            if p.meta().type == LOAD_BALANCER_PROVIDER_TYPE_NAME:
+            pm = p.meta()
+            if pm.type == LOAD_BALANCER_PROVIDER_TYPE_NAME:
                 lb_providers.append(p)
             else:
-                worker_provider_ids.add(p.meta().id)
+                worker_provider_ids.add(pm.id)
         for p in lb_providers:
+            p.load_balance_service.reload_strategy()
+            p._load_other_providers()
             weights = p.provider_config.get("lb_weights", {})
-            for lb_key, provider_weight in list(weights.items()):
+            for provider_weight in weights.values():
                 provider_id = provider_weight.get("provider", "") if provider_weight else ""
                 if provider_id not in worker_provider_ids:
                     provider_id and logger.warning(f"节点模型提供商【{provider_id}】未启用，该权重节点配置将被忽略")
@@ -75,7 +142,12 @@ class LBProviderPlugin(Star):
     def inject_provider_metadata(self):
         """动态注入配置到CONFIG_METADATA_2"""
         try:
-            from astrbot.core.config.default import CONFIG_METADATA_2
+            CONFIG_METADATA_2 = _config_metadata()
+
+            # 注入内容只由节点数量决定，节点数量未变且模板仍在时无需重建
+            config_template = CONFIG_METADATA_2["provider_group"]["metadata"]["provider"]["config_template"]
+            if self.lb_provider_node_total == self._injected_node_total and "Load Balancer" in config_template:
+                return
 
             weights_items = {}
             weights_tmpl = {}
@@ -100,7 +172,6 @@ class LBProviderPlugin(Star):
                 }
 
             # 更新CONFIG_METADATA_2中的配置模板
-            config_template = CONFIG_METADATA_2["provider_group"]["metadata"]["provider"]["config_template"]
             config_template["Load Balancer"] = {
                 "id": "load_balancer_default",
                 "type": LOAD_BALANCER_PROVIDER_TYPE_NAME,
@@ -109,7 +180,7 @@ class LBProviderPlugin(Star):
                 "api_base": "自动切换",
                 "provider_type": "chat_completion",
                 "enable": False,
-                "lb_strategy": "round_robin",  # 负载均衡策略: round_robin, random, weighted, least_failure, fastest
+                "lb_strategy": "round_robin",  # 负载均衡策略: round_robin, random, weighted, least_failure, fastest, consistent_hash, power_of_two
                 "lb_weights": weights_tmpl,  # 动态生成的权重配置
                 "lb_health_check_interval": "1800"  # 健康检查间隔（秒）
             }
@@ -119,8 +190,10 @@ class LBProviderPlugin(Star):
                 "lb_strategy": {
                     "description": "负载均衡策略",
                     "type": "string",
-                    "options": ["round_robin", "random", "weighted", "least_failure", "fastest"],
-                    "hint": "轮询-round_robin, 随机-random, 加权-weighted, 最少故障-least_failure, 最快响应-fastest",
+                    "options": ["round_robin", "random", "weighted", "least_failure", "fastest", "consistent_hash",
+                                "power_of_two"],
+                    "hint": "轮询-round_robin, 随机-random, 加权-weighted, 最少故障-least_failure, 最快响应-fastest, "
+                            "会话一致性哈希-consistent_hash, 二选一最少并发-power_of_two",
                 },
                 "lb_health_check_interval": {
                     "description": "健康检查间隔（秒）",
@@ -135,14 +208,16 @@ class LBProviderPlugin(Star):
                 },
             })
 
+            self._injected_node_total = self.lb_provider_node_total
             logger.debug(f"已为 {LOAD_BALANCER_PROVIDER_TYPE_NAME} 适配器注入动态配置")
         except Exception as expt:
             logger.debug(f"注入 {LOAD_BALANCER_PROVIDER_TYPE_NAME} 动态配置失败: {expt}")
 
     def remove_dynamic_config(self):
         """删除动态注入的配置"""
+        self._injected_node_total = None
         try:
-            from astrbot.core.config.default import CONFIG_METADATA_2
+            CONFIG_METADATA_2 = _config_metadata()
 
             # 从配置模板中移除负载均衡配置
             config_template = CONFIG_METADATA_2["provider_group"]["metadata"]["provider"]["config_template"]
@@ -1,6 +1,8 @@
 import asyncio
+import contextlib
 import inspect
-from collections import defaultdict
+import logging
+import sys
 from typing import List
 
 from astrbot.api import logger
@@ -12,12 +14,30 @@ from .load_balancer_strategies import (
     RandomStrategy,
     WeightedStrategy,
     LeastFailureStrategy,
-    FastestStrategy
+    FastestStrategy,
+    ConsistentHashStrategy,
+    LoadBalanceStrategy,
+    PowerOfTwoStrategy,
+    ProviderStats,
+    build_weight_table,
 )
 
 FAILURE_RATE_THRESHOLD = 0.5
 MAX_CONSECUTIVE_FAILURES = 3
 
+# 健康检查结果缓存有效期（秒）
+HEALTH_CHECK_CACHE_TTL = 5.0
+
+# 健康检查结果缓存（provider_id -> (检查时间, 是否健康)）与单飞锁
+# 同一后端provider可能被多个负载均衡实例引用，因此在所有实例间共享
+_health_cache: dict[str, tuple[float, bool]] = {}
+_health_locks: dict[str, asyncio.Lock] = {}
+
+# provider方法类型标记
+METHOD_KIND_ASYNCGEN = 0
+METHOD_KIND_COROUTINE = 1
+METHOD_KIND_SYNC = 2
+
 
 class LoadBalanceService:
     """负载均衡服务，负责管理负载均衡和故障转移逻辑"""
@@ -25,32 +45,79 @@ class LoadBalanceService:
     def __init__(self, provider_instance):
         self.provider = provider_instance
         self._other_providers = self.provider.work_providers
-        self._strategy = self.provider.strategy
+        self._strategy = sys.intern(self.provider.strategy)
         self._fallback_order = self.provider.fallback_order
+        self._fallback_key = tuple(self._fallback_order or ())
         self._provider_weights = self.provider.provider_weights
+        # 权重配置在初始化时展开为 provider_id -> 权重，避免每次选择时扫描节点配置
+        self._weight_table = build_weight_table(self._provider_weights)
 
         self.strategies = {
             "round_robin": RoundRobinStrategy(provider_instance),
             "random": RandomStrategy(provider_instance),
             "weighted": WeightedStrategy(provider_instance),
             "least_failure": LeastFailureStrategy(provider_instance, exploration_factor=2.0),
-            "fastest": FastestStrategy(provider_instance, exploration_factor=2.0)
+            "fastest": FastestStrategy(provider_instance, exploration_factor=2.0),
+            "consistent_hash": ConsistentHashStrategy(provider_instance),
+            "power_of_two": PowerOfTwoStrategy(provider_instance),
         }
+        self._active_strategy = self.get_strategy(self._strategy)
+        # 需要感知统计或健康状态更新的策略；非当前策略也同步更新，切换策略后其状态仍然有效
+        self._stats_listeners = [
+            strategy for strategy in self.strategies.values()
+            if type(strategy).on_stats_updated is not LoadBalanceStrategy.on_stats_updated
+            or type(strategy).on_health_updated is not LoadBalanceStrategy.on_health_updated
+        ]
 
         # 状态管理
-        self.provider_stats = defaultdict(lambda: {"success": 0, "failure": 0, "latency": 0.0, "throughput": 0.0})
+        self.provider_stats: dict[str, ProviderStats] = {}
         self.provider_health = {}
-        # 统计更新队列
-        self.stats_queue = asyncio.Queue()
-        self.stats_task = asyncio.create_task(self.queue_consumer())
+        # 有序provider缓存 (工作provider版本号, 有序provider, ID)，以及与之对齐的健康位数组
+        # 版本号只增不减，旧条目不会再命中，因此只保留最新一份
+        self._ordered_cache: tuple[int, tuple, tuple] | None = None
+        self._order_version = 0
+        self._health_ids = ()
+        self._health_pos = {}
+        self._health_bits = []
+        # (provider类, 方法名) -> 方法类型标记
+        self._method_kind_cache: dict[tuple[type, str], int] = {}
 
     def get_strategy(self, strategy_name: str):
         """获取指定策略"""
         return self.strategies.get(strategy_name, self.strategies["random"])  # 默认随机策略
 
+    def reload_strategy(self):
+        """按provider当前配置刷新生效的策略"""
+        self._strategy = sys.intern(self.provider.strategy)
+        self._active_strategy = self.get_strategy(self._strategy)
+
+    def _method_kind(self, provider: Provider, method_name: str) -> int:
+        """获取provider方法的类型标记，按 (provider类, 方法名) 缓存"""
+        cache_key = (type(provider), method_name)
+        kind = self._method_kind_cache.get(cache_key)
+        if kind is None:
+            func = getattr(type(provider), method_name, None)
+            if inspect.isasyncgenfunction(func):
+                kind = METHOD_KIND_ASYNCGEN
+            elif inspect.iscoroutinefunction(func):
+                kind = METHOD_KIND_COROUTINE
+            else:
+                kind = METHOD_KIND_SYNC
+            self._method_kind_cache[cache_key] = kind
+        return kind
+
+    @staticmethod
+    def _provider_id(provider: Provider) -> str:
+        """获取provider ID，优先使用_load_other_providers缓存的_lb_id，未缓存时回退到meta()"""
+        provider_id = getattr(provider, "_lb_id", None)
+        if provider_id is None:
+            provider_id = provider.meta().id
+        return provider_id
+
     def _get_providers_with_order(self, providers: List[Provider], fallback_order: List[str]) -> List[Provider]:
         """根据fallback_order获取provider顺序"""
-        provider_map = {provider.meta().id: provider for provider in providers}
+        get_id = self._provider_id
+        provider_map = {get_id(provider): provider for provider in providers}
         ordered_providers = []
 
         if fallback_order:
@@ -66,15 +133,52 @@ class LoadBalanceService:
 
         return ordered_providers
 
+    def invalidate_order(self):
+        """工作provider列表变化后调用，使有序provider缓存失效"""
+        self._order_version += 1
+
+    def _compute_order(self, fallback_order: tuple):
+        """计算有序provider及其ID"""
+        # 同一provider可能配置在多个权重节点中，只保留首次出现的位置，保证有序列表中每个provider只出现一次
+        fallback_order = list(dict.fromkeys(fallback_order))
+        providers = tuple(self._get_providers_with_order(self._other_providers, fallback_order))
+        get_id = self._provider_id
+        ids = tuple(get_id(provider) for provider in providers)
+        return providers, ids
+
+    def _get_ordered_providers(self):
+        """获取缓存的有序provider及其ID，并同步健康位数组"""
+        cache = self._ordered_cache
+        if cache is None or cache[0] != self._order_version:
+            cache = self._ordered_cache = (self._order_version, *self._compute_order(self._fallback_key))
+        _, providers, ids = cache
+        if ids is not self._health_ids:
+            self._health_ids = ids
+            self._health_pos = {provider_id: idx for idx, provider_id in enumerate(ids)}
+            self._health_bits = [self.provider_health.get(provider_id, True) for provider_id in ids]
+        return providers, ids
+
+    def _set_health(self, provider_id: str, is_healthy: bool):
+        """更新provider健康状态，同时更新健康位数组，状态变化时通知策略"""
+        if self.provider_health.get(provider_id, True) != is_healthy:
+            for strategy in self._stats_listeners:
+                strategy.on_health_updated(provider_id, is_healthy)
+        self.provider_health[provider_id] = is_healthy
+        idx = self._health_pos.get(provider_id)
+        if idx is not None:
+            self._health_bits[idx] = is_healthy
+
     def _get_healthy_providers(self, providers: List[Provider]) -> List[Provider]:
         """获取健康provider列表"""
         healthy_providers = []
+        get_id = self._provider_id
+        get_health = self.provider_health.get
         for provider in providers:
-            is_healthy = self.provider_health.get(provider.meta().id, True)
-            if is_healthy:
+            provider_id = get_id(provider)
+            if get_health(provider_id, True):
                 healthy_providers.append(provider)
-            else:
-                logger.debug(f"provider {provider.meta().id} 不健康，跳过")
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("provider %s 不健康，跳过", provider_id)
         return healthy_providers
 
     async def _execute_with_load_balance_core(self, method_name: str, **kwargs):
@@ -85,188 +189,236 @@ class LoadBalanceService:
         :param kwargs: 其他参数
         """
 
-        available_providers = self._get_providers_with_order(self._other_providers, self._fallback_order)
-        if not available_providers:
+        now = asyncio.get_running_loop().time
+        providers, provider_ids = self._get_ordered_providers()
+        if not providers:
             raise RuntimeError("负载均衡器没有可用的provider")
 
-        logger.debug(f"开始执行负载均衡，策略：{self._strategy}，"
-                     f"可用provider：{[p.meta().id for p in available_providers]}")
-
+        # 调试日志开关只在请求开始时读取一次，避免关闭DEBUG时仍格式化日志
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("开始执行负载均衡，策略：%s，可用provider：%s", self._strategy, list(provider_ids))
+
+        # 按下标记录已尝试过的provider及剩余可尝试的数量
+        tried = [False] * len(providers)
+        remaining = len(providers)
+        # 兜底选择的查找起点：下标小于它的provider均已尝试过
+        next_fallback = 0
+        # 健康provider列表只在请求开始时计算一次，之后随失败的provider同步移除
+        # 重试过程中其他provider的健康状态变化不再反映到本次请求
+        health_bits = self._health_bits
+        healthy_available = [provider for provider, is_healthy in zip(providers, health_bits) if is_healthy]
+        healthy_ids = [provider_id for provider_id, is_healthy in zip(provider_ids, health_bits) if is_healthy]
+        # 健康provider在有序列表中的下标，与healthy_available对齐，选中后直接得到下标而无需按对象查找
+        healthy_idx = [idx for idx, is_healthy in enumerate(health_bits) if is_healthy]
+        # 本次请求中已失败的provider下标
+        failed = []
+        _kwargs = {
+            "provider_ids": healthy_ids,
+            "all_ids": provider_ids,
+            "positions": healthy_idx,
+            "failed": failed,
+            "health_bits": health_bits,
+            "session_id": kwargs.get("session_id"),
+            "stats": self.provider_stats,
+            "weights": self._weight_table,
+        }
         tried_count = 0
-        while available_providers:
+        while remaining:
             tried_count += 1
-            healthy_available = [p for p in available_providers if self.provider_health.get(p.meta().id, True)]
-            _kwargs = {
-                "stats": self.provider_stats,
-                "weights": self._provider_weights,
-            }
-            selected_provider = await self.get_strategy(self._strategy).select_provider(healthy_available, **_kwargs)
-
-            if not selected_provider:
-                if available_providers:
-                    selected_provider = available_providers[0]
-                    logger.debug(f"策略无法选择provider，使用兜底选择: {selected_provider.meta().id}")
-                else:
-                    logger.debug(f"没有更多provider可尝试")
-                    break
-            logger.debug(f"第{tried_count}次[负载均衡|故障转移]选择Provider: {selected_provider.meta().id}")
-
-            start_time = asyncio.get_event_loop().time()
+            # 只剩一个健康provider时无需调用策略；策略返回的是在健康列表中的位置
+            if len(healthy_available) == 1:
+                pos = 0
+            else:
+                pos = await self._active_strategy.select_index(healthy_available, **_kwargs)
+
+            if pos is not None:
+                selected_idx = healthy_idx[pos]
+            else:
+                # 健康provider均已尝试，按故障转移顺序选择第一个未尝试的provider兜底
+                while tried[next_fallback]:
+                    next_fallback += 1
+                selected_idx = next_fallback
+                if debug:
+                    logger.debug("策略无法选择provider，使用兜底选择: %s", provider_ids[selected_idx])
+            selected_provider = providers[selected_idx]
+            selected_id = provider_ids[selected_idx]
+            if debug:
+                logger.debug("第%d次[负载均衡|故障转移]选择Provider: %s", tried_count, selected_id)
+
+            # 记录进行中的请求数，请求结束（含失败、提前关闭）时在finally中减回
+            selected_stats = self._stats_for(selected_id)
+            selected_stats.inflight += 1
+            start_time = now()
             try:
+                kind = self._method_kind(selected_provider, method_name)
                 result = getattr(selected_provider, method_name)(**kwargs)
                 tokens, size = 0, 0
-
-                def _analyze(data):
-                    nonlocal tokens, size
-                    t, s = self.analyze_response(data)
-                    tokens += t
-                    size += s
-                    return data
+                analyze = self.analyze_response
 
                 try:
-                    if inspect.isasyncgen(result):
+                    # 普通方法可能经装饰器包装后返回协程或异步生成器，此时按运行时类型判断
+                    if kind == METHOD_KIND_SYNC:
+                        if inspect.isasyncgen(result):
+                            kind = METHOD_KIND_ASYNCGEN
+                        elif inspect.iscoroutine(result):
+                            kind = METHOD_KIND_COROUTINE
+
+                    if kind == METHOD_KIND_ASYNCGEN:
                         async for chunk in result:
-                            yield _analyze(chunk)
-                    elif inspect.iscoroutine(result):
-                        result = await result
-                        yield _analyze(result)
+                            t, s = analyze(chunk)
+                            tokens += t
+                            size += s
+                            yield chunk
                     else:
-                        yield _analyze(result)
+                        if kind == METHOD_KIND_COROUTINE:
+                            result = await result
+                        t, s = analyze(result)
+                        tokens += t
+                        size += s
+                        yield result
                 except GeneratorExit:
                     pass
 
-                elapsed = asyncio.get_event_loop().time() - start_time
+                elapsed = now() - start_time
                 tokens = tokens if int(tokens) > 0 else size
-                self.record_success(selected_provider.meta().id, elapsed, tokens)
-                # logger.debug(f"provider {selected_provider.meta().id} 请求成功，耗时: {elapsed:.3f}秒，tokens: {tokens}")
+                self.record_success(selected_id, elapsed, tokens)
+                # logger.debug(f"provider {selected_id} 请求成功，耗时: {elapsed:.3f}秒，tokens: {tokens}")
                 return
             except Exception as e:
-                # logger.debug(f"provider {selected_provider.meta().id} 请求失败: {e}")
-                self.record_failure(selected_provider.meta().id)
+                # logger.debug(f"provider {selected_id} 请求失败: {e}")
+                self.record_failure(selected_id)
 
                 # next Provider
-                if selected_provider in available_providers:
-                    available_providers.remove(selected_provider)
-
-                if not available_providers:
-                    logger.debug(f"所有provider都失败了，抛出异常")
+                tried[selected_idx] = True
+                remaining -= 1
+                failed.append(selected_idx)
+                # 健康列表按策略返回的位置直接删除，无需查找；保持顺序，轮询等策略依赖其顺序
+                if pos is not None:
+                    del healthy_available[pos]
+                    del healthy_ids[pos]
+                    del healthy_idx[pos]
+
+                if not remaining:
+                    logger.debug("所有provider都失败了，抛出异常")
                     raise e
+            finally:
+                selected_stats.inflight -= 1
+
+    async def cached_test(self, provider: Provider, ttl: float = HEALTH_CHECK_CACHE_TTL) -> bool:
+        """探测provider是否可用，有效期内复用上次结果，并发探测同一provider时只实际执行一次"""
+        provider_id = self._provider_id(provider)
+        now = asyncio.get_running_loop().time
+        cached = _health_cache.get(provider_id)
+        if cached is not None and now() - cached[0] < ttl:
+            return cached[1]
+
+        lock = _health_locks.get(provider_id)
+        if lock is None:
+            lock = _health_locks[provider_id] = asyncio.Lock()
+        async with lock:
+            # 等待锁期间可能已有其他探测完成
+            cached = _health_cache.get(provider_id)
+            if cached is not None and now() - cached[0] < ttl:
+                return cached[1]
+            try:
+                await provider.test()
+                is_healthy = True
+            except Exception:
+                is_healthy = False
+            _health_cache[provider_id] = (now(), is_healthy)
+        return is_healthy
 
     def analyze_response(self, resp: LLMResponse | None):
-        if not resp or not isinstance(resp, LLMResponse):
+        # isinstance对None同样返回False，无需额外判空
+        if not isinstance(resp, LLMResponse):
             return 0, 0
         tokens = resp.raw_completion.usage.completion_tokens if resp.raw_completion else 0
-        if resp.result_chain:
-            size = sum([len(getattr(c, 'text')) for c in resp.result_chain.chain if getattr(c, 'text')])
+        result_chain = resp.result_chain
+        if result_chain is not None and result_chain.chain:
+            # 生成器直接交给sum，且每个消息段只取一次text
+            size = sum(len(t) for c in result_chain.chain for t in (getattr(c, 'text', None),) if t)
         else:
+            # 流式分片通常只有completion_text，跳过消息链求和
             size = len(resp.completion_text or resp.reasoning_content or '')
         return tokens, size
 
     async def execute_with_load_balance_and_fallback(self, method_name: str, **kwargs) -> LLMResponse:
         """执行带负载均衡和故障转移的请求"""
         chunks = []
-        async for chunk in self._execute_with_load_balance_core(method_name, **kwargs):
-            chunks.append(chunk)
+        async with contextlib.aclosing(self._execute_with_load_balance_core(method_name, **kwargs)) as results:
+            async for chunk in results:
+                chunks.append(chunk)
         return chunks[0] if chunks else None
 
     async def execute_with_load_balance_and_fallback_stream(self, method_name: str, **kwargs):
         """执行带负载均衡和故障转移的流式请求"""
-        async for chunk in self._execute_with_load_balance_core(method_name, **kwargs):
-            yield chunk
+        # 调用方提前关闭时同步关闭内部生成器，使进行中的请求数立即减回，而不是等到被垃圾回收
+        async with contextlib.aclosing(self._execute_with_load_balance_core(method_name, **kwargs)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def _notify_stats_updated(self, provider_id: str, stats: ProviderStats):
+        """通知策略provider统计数据已更新"""
+        for strategy in self._stats_listeners:
+            strategy.on_stats_updated(provider_id, stats)
+
+    def _stats_for(self, provider_id: str) -> ProviderStats:
+        """获取provider统计数据，不存在时创建"""
+        stats = self.provider_stats.get(provider_id)
+        if stats is None:
+            stats = self.provider_stats[provider_id] = ProviderStats()
+        return stats
 
-    async def _record_success(self, provider_id: str, latency: float, tokens: int):
+    def record_success(self, provider_id: str, latency: float, tokens: int):
         """记录成功请求"""
-        self.provider_stats[provider_id]["success"] += 1
-
-        # EWMA
-        alpha = 0.5  # 平滑参数，值越接近1，对最新值越敏感
+        stats = self._stats_for(provider_id)
+        stats.success += 1
 
-        # 指数加权移动平均: new_avg = alpha * new_value + (1 - alpha) * old_avg
-        # 计算latency
-        current_latency = self.provider_stats[provider_id]["latency"]
-        new_latency = latency if current_latency == 0 else alpha * latency + (1 - alpha) * current_latency
-        self.provider_stats[provider_id]["latency"] = new_latency
+        # EWMA（alpha=0.5）: new_avg = 0.5 * (new_value + old_avg)，首个样本直接取值
+        stats.latency = latency if stats.latency == 0.0 else 0.5 * (latency + stats.latency)
+        tp = tokens / latency if latency > 0 else 0.0
+        stats.throughput = tp if stats.throughput == 0.0 else 0.5 * (tp + stats.throughput)
 
-        # 计算throughput
-        tp = tokens / latency if latency > 0 else 0
-        current_tp = self.provider_stats[provider_id]["throughput"]
-        new_tp = tp if current_tp == 0 else alpha * tp + (1 - alpha) * current_tp
-        self.provider_stats[provider_id]["throughput"] = new_tp
+        self._notify_stats_updated(provider_id, stats)
 
         # 记录provider为健康状态
-        self.provider_health[provider_id] = True
-        logger.debug(
-            f"记录成功: provider {provider_id}, "
-            f"延迟: {latency:.3f}, "
-            f"吞吐量: {self.provider_stats[provider_id]['throughput']:.3f} tokens/秒, "
-            f"成功次数: {self.provider_stats[provider_id]['success']}"
-        )
-
-    async def _record_failure(self, provider_id: str):
-        """记录失败请求"""
-        self.provider_stats[provider_id]["failure"] += 1
-
-        stats = self.provider_stats[provider_id]
-        total = stats["success"] + stats["failure"]
-        failure_rate = stats["failure"] / total if total > 0 else 0
+        self._set_health(provider_id, True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("记录成功: provider %s, 延迟: %.3f, 吞吐量: %.3f tokens/秒, 成功次数: %d",
+                         provider_id, latency, stats.throughput, stats.success)
+
+    def record_failure(self, provider_id: str):
+        """记录失败请求（供外部调用）"""
+        stats = self._stats_for(provider_id)
+        stats.failure += 1
+        self._notify_stats_updated(provider_id, stats)
+
+        total = stats.success + stats.failure
+        failure_rate = stats.failure / total if total > 0 else 0
 
         # 如果失败率超过阈值，标记为不健康
         if failure_rate > FAILURE_RATE_THRESHOLD:
-            self.provider_health[provider_id] = False
-            logger.debug(f"记录失败: provider {provider_id}, 失败率: {failure_rate:.2%}, 标记为不健康")
+            self._set_health(provider_id, False)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("记录失败: provider %s, 失败率: %.2f%%, 标记为不健康", provider_id, failure_rate * 100)
         # 或者如果连续失败超过阈值，也标记为不健康
-        elif stats["failure"] >= MAX_CONSECUTIVE_FAILURES and stats["success"] == 0:
-            self.provider_health[provider_id] = False
-            logger.debug(f"记录失败: provider {provider_id}, 连续失败 {stats['failure']} 次, 标记为不健康")
-        else:
-            logger.debug(f"记录失败: provider {provider_id}, 失败次数: {stats['failure']}, 失败率: {failure_rate:.2%}")
+        elif stats.failure >= MAX_CONSECUTIVE_FAILURES and stats.success == 0:
+            self._set_health(provider_id, False)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("记录失败: provider %s, 连续失败 %d 次, 标记为不健康", provider_id, stats.failure)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("记录失败: provider %s, 失败次数: %d, 失败率: %.2f%%",
+                         provider_id, stats.failure, failure_rate * 100)
 
-    async def _reset_failure_count(self, provider_id: str):
+    def reset_failure_count(self, provider_id: str):
         """重置失败计数（供健康检查调用）"""
-        if provider_id in self.provider_stats:
+        stats = self.provider_stats.get(provider_id)
+        if stats is not None:
             # 尝试减少失败次数以反映健康状态
-            self.provider_stats[provider_id]["failure"] = max(0, self.provider_stats[provider_id]["failure"] - 1)
-
-    def record_success(self, provider_id: str, latency: float, tokens: int):
-        self.queue_product(self._record_success, provider_id, latency, tokens)
-
-    def record_failure(self, provider_id: str):
-        """记录失败请求（供外部调用）"""
-        self.queue_product(self._record_failure, provider_id)
-
-    def reset_failure_count(self, provider_id: str):
-        self.queue_product(self._reset_failure_count, provider_id)
-
-    def queue_product(self, func, *args, **kwargs):
-        self.stats_queue.put_nowait((func, args, kwargs))
-
-    async def queue_consumer(self):
-        """处理统计更新的后台任务"""
-
-        while True:
-            try:
-                # 等待统计更新请求
-                func, args, kwargs = await self.stats_queue.get()
-                try:
-                    result = await func(*args, **kwargs)
-                finally:
-                    self.stats_queue.task_done()
-
-            except asyncio.CancelledError:
-                logger.debug("统计处理任务被取消")
-                break
-            except Exception as e:
-                logger.error(f"处理统计更新时出错: {e}")
-                continue
+            stats.failure = max(0, stats.failure - 1)
+            self._notify_stats_updated(provider_id, stats)
 
     async def terminate(self):
         """终止时的清理工作"""
-        if hasattr(self, 'stats_task') and self.stats_task and not self.stats_task.done():
-            self.stats_task.cancel()
-            try:
-                await self.stats_task
-            except asyncio.CancelledError:
-                pass
-
-        # 等待所有队列项处理完成
-        await self.stats_queue.join()
+        self._ordered_cache = None
@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import re
 from typing import List
 
 from astrbot.api import logger
@@ -14,6 +16,8 @@ from .load_balance_service import LoadBalanceService
 DEFAULT_STRATEGY = "random"
 DEFAULT_HEALTH_CHECK_INTERVAL = 30
 WEIGHT_DEFAULT_VALUE = 1
+MAX_CONCURRENT_HEALTH_CHECKS = 5
+WEIGHT_NODE_KEY_PATTERN = re.compile(r"^weight_node_(\d+)$")
 
 
 @register_provider_adapter(
@@ -29,6 +33,8 @@ class LoadBalancerProvider(Provider):
 
     def __init__(self, provider_config: dict, provider_settings: dict):
         super().__init__(provider_config, provider_settings)
+        # meta在初始化后不再变化，预先计算，meta()直接返回
+        self._meta = super().meta()
 
         # 从配置中获取负载均衡策略和设置
         self.strategy = provider_config.get("lb_strategy", DEFAULT_STRATEGY)  # 默认策略
@@ -42,21 +48,24 @@ class LoadBalancerProvider(Provider):
         except (ValueError, TypeError):
             self.health_check_interval = DEFAULT_HEALTH_CHECK_INTERVAL  # 如果转换失败，使用默认值
 
-        node_keys = [k for k in self.provider_weights.keys()
-                     if k.startswith("weight_node_") and self.provider_weights[k].get("provider")]
-        node_keys = sorted(node_keys, key=lambda x: int(x.split("_")[-1]))
-        self.fallback_order = [self.provider_weights[k]["provider"] for k in node_keys]
+        # 单次遍历提取 (节点序号, provider)，按序号排序得到故障转移顺序
+        nodes = []
+        for key, node in self.provider_weights.items():
+            match = WEIGHT_NODE_KEY_PATTERN.match(key)
+            if match and isinstance(node, dict) and node.get("provider"):
+                nodes.append((int(match.group(1)), node["provider"]))
+        nodes.sort()
+        self.fallback_order = [provider_id for _, provider_id in nodes]
 
-        # 这些将在initialize方法中设置
+        # 这些将在initialize方法中设置，请求路径不再检查或加载
         self.work_providers = []
+        self._work_provider_ids = ()
         self.health_check_task = None
+        self._health_check_stop = asyncio.Event()
         # 初始化负载均衡服务（包含所有状态管理）
         self.load_balance_service = LoadBalanceService(self)
-        self._meta = super().meta()
 
     def meta(self):
-        if not self._meta:
-            self._meta = super().meta()
         return self._meta
 
     def _load_other_providers(self):
@@ -65,35 +74,33 @@ class LoadBalancerProvider(Provider):
             # 获取所有实例列表
             all_instances = PROVIDER_MANAGER.get_insts()
 
-            # 过滤掉自己
-            _providers = [
-                provider for provider in all_instances
-                if provider.meta().id != self.meta().id
-            ]
+            # 过滤掉自己，并缓存provider ID，供排序及负载均衡热路径直接读取
+            # 每个实例只调用一次meta()，自身ID提前取出
+            self_id = self.meta().id
+            _providers = []
+            for provider in all_instances:
+                provider_id = provider.meta().id
+                if provider_id != self_id:
+                    provider._lb_id = provider_id
+                    _providers.append(provider)
 
             # 如果指定了fallback_order且当前策略不是weighted，则按照指定顺序重新排序
             # 加权策略使用权重配置而不是fallback_order作为排序依据
             if self.fallback_order and self.strategy != "weighted":
-                # 使用字典快速索引所有providers
-                provider_map = {provider.meta().id: provider for provider in _providers}
-                ordered_providers = []
-
-                # 提取字典中的provider_id值
-                for provider_id in self.fallback_order:
-                    if provider_id in provider_map:
-                        ordered_providers.append(provider_map[provider_id])
-
-                # 添加未在fallback_order中指定的provider
-                fallback_set = set(self.fallback_order)
-                for provider in _providers:
-                    if provider.meta().id not in fallback_set:
-                        ordered_providers.append(provider)
-                _providers = ordered_providers
+                # 按fallback_order中的位置排序，未指定的provider排在末尾；稳定排序保持其原有顺序
+                rank = {}
+                for idx, provider_id in enumerate(self.fallback_order):
+                    rank.setdefault(provider_id, idx)
+                unranked = len(self.fallback_order)
+                _providers.sort(key=lambda provider: rank.get(provider._lb_id, unranked))
 
             self.work_providers.clear()
             self.work_providers.extend(_providers)
-        except Exception as e:
-            pass
+            self._work_provider_ids = tuple(provider._lb_id for provider in self.work_providers)
+            self.load_balance_service.invalidate_order()
+        except (AttributeError, TypeError, KeyError) as e:
+            # 加载失败时保留原有列表，等待下一次provider变化时重新加载
+            logger.warning(f"加载后端Provider失败: {e}")
 
     def get_current_key(self) -> str:
         """负载均衡器不使用具体的key，返回空字符串"""
@@ -119,13 +126,6 @@ class LoadBalancerProvider(Provider):
             **kwargs,
     ) -> LLMResponse:
         """通过负载均衡策略执行文本聊天"""
-        # 确保已加载其他providers
-        if not self.work_providers:
-            self._load_other_providers()
-
-        if not self.work_providers:
-            raise Exception("没有可用的后端Provider")
-
         # 使用负载均衡选出provider并执行请求，包含故障转移逻辑
         return await self.load_balance_service.execute_with_load_balance_and_fallback(
             method_name="text_chat",
@@ -153,15 +153,9 @@ class LoadBalancerProvider(Provider):
             **kwargs,
     ):
         """流式文本聊天"""
-        # 确保已加载其他providers
-        if not self.work_providers:
-            self._load_other_providers()
-
-        if not self.work_providers:
-            raise Exception("没有可用的后端Provider")
-
         # 使用负载均衡选出provider并执行流式请求，包含故障转移逻辑
-        async for chunk in self.load_balance_service.execute_with_load_balance_and_fallback_stream(
+        # 调用方提前关闭时同步关闭服务层生成器，使进行中的请求数立即减回
+        async with contextlib.aclosing(self.load_balance_service.execute_with_load_balance_and_fallback_stream(
                 method_name="text_chat_stream",
                 prompt=prompt,
                 session_id=session_id,
@@ -172,35 +166,57 @@ class LoadBalancerProvider(Provider):
                 tool_calls_result=tool_calls_result,
                 model=None,
                 **kwargs
-        ):
-            yield chunk
+        )) as chunks:
+            async for chunk in chunks:
+                yield chunk
 
     async def initialize(self):
         """初始化方法，在这里可以进行额外的初始化工作"""
+        # 加载后端providers；之后的provider增减由插件的load_provider/terminate_provider钩子触发重新加载
+        self._load_other_providers()
         # 启动健康检查任务
         if self.health_check_interval:
             self.health_check_task = asyncio.create_task(self._health_check_loop())
 
     async def _health_check_loop(self):
-        """定期健康检查任务"""
-        while True:
+        """定期健康检查任务，等待间隔期间收到停止信号立即退出"""
+        while not self._health_check_stop.is_set():
+            try:
+                await asyncio.wait_for(self._health_check_stop.wait(), timeout=self.health_check_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
             try:
-                await asyncio.sleep(self.health_check_interval)
                 await self._perform_health_check()
+            except asyncio.CancelledError:
+                # 任务被取消时必须退出循环
+                raise
             except Exception as e:
-                pass
+                logger.warning(f"健康检查执行失败: {e}")
 
     async def _perform_health_check(self):
-        """执行健康检查"""
-        for provider in self.work_providers:
-            logger.info(f"正在检查后端Provider {provider.meta().id} 的健康状态...")
-            try:
-                await provider.test()
+        """执行健康检查，各后端Provider并发探测"""
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_HEALTH_CHECKS)
+        provider_ids = self._work_provider_ids
+        results = await asyncio.gather(
+            *(self._check_one(provider, provider_id, semaphore)
+              for provider, provider_id in zip(self.work_providers, provider_ids)),
+            return_exceptions=True
+        )
+        for provider_id, result in zip(provider_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"后端Provider {provider_id} 健康检查出错: {result}")
+
+    async def _check_one(self, provider: Provider, provider_id: str, semaphore: asyncio.Semaphore):
+        """检查单个后端Provider的健康状态"""
+        async with semaphore:
+            logger.info(f"正在检查后端Provider {provider_id} 的健康状态...")
+            if await self.load_balance_service.cached_test(provider):
                 # 如果测试成功，可以重置失败统计
-                self.load_balance_service.reset_failure_count(provider.meta().id)
-            except Exception as e:
+                self.load_balance_service.reset_failure_count(provider_id)
+            else:
                 # 测试失败，增加失败统计
-                await self.load_balance_service.record_failure(provider.meta().id)
+                self.load_balance_service.record_failure(provider_id)
 
     async def terminate(self):
         """终止时的清理工作"""
@@ -212,11 +228,11 @@ class LoadBalancerProvider(Provider):
         astrbot_config.save_config()
 
         if hasattr(self, 'health_check_task') and self.health_check_task and not self.health_check_task.done():
+            # 停止信号结束等待间隔，取消任务则中断正在执行的健康检查，两者都不等待
+            self._health_check_stop.set()
             self.health_check_task.cancel()
-            try:
-                await self.health_check_task
-            except asyncio.CancelledError:
-                pass
+            # asyncio.wait不抛出任务自身的取消异常，terminate本身被取消时仍会向上传播
+            await asyncio.wait((self.health_check_task,))
 
         await self.load_balance_service.terminate()
 
@@ -1,10 +1,97 @@
-import asyncio
+import hashlib
 import math
 import random
+from bisect import bisect_left
 from typing import List, Optional, Dict, Any
 
 from astrbot.core.provider.provider import Provider
 
+DEFAULT_WEIGHT = 1
+
+
+class ProviderStats:
+    """单个provider的统计数据"""
+
+    __slots__ = ("success", "failure", "latency", "throughput", "inflight")
+
+    def __init__(self):
+        self.success = 0
+        self.failure = 0
+        self.latency = 0.0
+        self.throughput = 0.0
+        self.inflight = 0  # 进行中的请求数
+
+
+# 尚无统计数据的provider共用的只读默认值，不得修改
+_EMPTY_STATS = ProviderStats()
+
+
+def build_weight_table(weights: Dict[str, Any]) -> Dict[str, int]:
+    """将lb_weights节点配置展开为 provider_id -> 权重 的映射（同一provider以首个节点为准）"""
+    table = {}
+    for weight_config in (weights or {}).values():
+        if not isinstance(weight_config, dict):
+            continue
+        provider_id = weight_config.get("provider")
+        if not provider_id or provider_id in table:
+            continue
+        try:
+            table[provider_id] = int(weight_config.get("weight", DEFAULT_WEIGHT))
+        except (ValueError, TypeError):
+            table[provider_id] = DEFAULT_WEIGHT
+    return table
+
+
+class FenwickTree:
+    """树状数组：O(log N)单点更新、求总和以及按累计值定位下标"""
+
+    __slots__ = ("_tree", "_values", "_top_bit")
+
+    def __init__(self, values: List[float]):
+        n = len(values)
+        self._values = list(values)
+        self._tree = [0.0] * (n + 1)
+        for i, value in enumerate(self._values, 1):
+            self._tree[i] += value
+            parent = i + (i & -i)
+            if parent <= n:
+                self._tree[parent] += self._tree[i]
+        self._top_bit = 1 << (n.bit_length() - 1) if n else 0
+
+    def update(self, idx: int, value: float) -> float:
+        """将下标idx的值设置为value，返回原值"""
+        old = self._values[idx]
+        delta = value - old
+        self._values[idx] = value
+        n = len(self._values)
+        i = idx + 1
+        while i <= n:
+            self._tree[i] += delta
+            i += i & -i
+        return old
+
+    def total(self) -> float:
+        """所有值之和"""
+        result = 0.0
+        i = len(self._values)
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def find(self, target: float) -> int:
+        """返回累计值首次超过target的下标"""
+        pos = 0
+        bit = self._top_bit
+        n = len(self._values)
+        while bit:
+            nxt = pos + bit
+            if nxt <= n and self._tree[nxt] <= target:
+                pos = nxt
+                target -= self._tree[nxt]
+            bit >>= 1
+        return min(pos, n - 1)
+
 
 class LoadBalanceStrategy:
     """负载均衡策略接口"""
@@ -14,8 +101,21 @@ class LoadBalanceStrategy:
 
     async def select_provider(self, providers: List[Provider], **kwargs) -> Optional[Provider]:
         """选择provider"""
+        idx = await self.select_index(providers, **kwargs)
+        return None if idx is None else providers[idx]
+
+    async def select_index(self, providers: List[Provider], **kwargs) -> Optional[int]:
+        """选择provider，返回其在providers中的下标，没有可选provider时返回None"""
         raise NotImplementedError
 
+    def on_stats_updated(self, provider_id: str, provider_stat: ProviderStats):
+        """provider统计数据更新后的回调，默认不处理"""
+        pass
+
+    def on_health_updated(self, provider_id: str, is_healthy: bool):
+        """provider健康状态变化后的回调，默认不处理"""
+        pass
+
 
 class ExplorationStrategy(LoadBalanceStrategy):
     """探索与利用平衡的负载均衡策略基类"""
@@ -23,55 +123,108 @@ class ExplorationStrategy(LoadBalanceStrategy):
     def __init__(self, provider_manager, exploration_factor=2.0):
         super().__init__(provider_manager)
         self.exploration_factor = exploration_factor
-
-    def calculate_base_score(self, provider_stat: dict) -> float:
+        # provider_id -> ((success, failure, throughput), 评分)，统计未变化时复用评分
+        self._score_cache: Dict[str, tuple] = {}
+        # 建立在完整有序provider ID上的评分树，不健康的provider对应位置为0，统计与健康状态变化时增量维护
+        self._tree_ids: tuple = ()
+        self._tree_pos: Dict[str, int] = {}
+        self._tree_health: List[bool] = []
+        self._tree_stats: Dict[str, ProviderStats] = {}
+        self._tree: Optional[FenwickTree] = None
+
+    def calculate_base_score(self, provider_stat: ProviderStats) -> float:
         """子类需要实现：计算基础评分"""
         raise NotImplementedError
 
-    async def select_provider(self, providers: List[Provider], stats: Dict[str, Any] = None, **kwargs) -> Optional[
-        Provider]:
+    def _score(self, provider_id: str, provider_stat: ProviderStats) -> float:
+        """计算provider的综合评分，统计未变化时复用缓存"""
+        stat_key = (provider_stat.success, provider_stat.failure, provider_stat.throughput)
+        cached = self._score_cache.get(provider_id)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+
+        total_selections = provider_stat.success + provider_stat.failure
+        # 计算探索奖励：选择次数越少，奖励越高
+        if total_selections > 0:
+            exploration_bonus = self.exploration_factor * math.sqrt(
+                math.log(total_selections + 1) / total_selections)
+        else:
+            # 从未被选择，给予最大探索奖励
+            exploration_bonus = self.exploration_factor * 10
+        # 综合评分 = 基础评分 + 探索奖励
+        score = self.calculate_base_score(provider_stat) + exploration_bonus
+        self._score_cache[provider_id] = (stat_key, score)
+        return score
+
+    def _rebuild_tree(self, all_ids: tuple, stats: Dict[str, ProviderStats], health_bits: List[bool] = None):
+        """有序provider变化时重建评分树"""
+        score = self._score
+        get_stat = stats.get
+        self._tree_ids = all_ids
+        self._tree_pos = {provider_id: idx for idx, provider_id in enumerate(all_ids)}
+        self._tree_health = list(health_bits) if health_bits is not None else [True] * len(all_ids)
+        self._tree_stats = stats
+        self._tree = FenwickTree([score(provider_id, get_stat(provider_id, _EMPTY_STATS)) if is_healthy else 0.0
+                                  for provider_id, is_healthy in zip(all_ids, self._tree_health)])
+
+    def on_stats_updated(self, provider_id: str, provider_stat: ProviderStats):
+        """只重算发生变化的provider评分并更新评分树"""
+        idx = self._tree_pos.get(provider_id)
+        if idx is not None and self._tree_health[idx]:
+            self._tree.update(idx, self._score(provider_id, provider_stat))
+
+    def on_health_updated(self, provider_id: str, is_healthy: bool):
+        """不健康的provider在评分树中置0，恢复健康后重新写入评分"""
+        idx = self._tree_pos.get(provider_id)
+        if idx is not None:
+            self._tree_health[idx] = is_healthy
+            score = self._score(provider_id, self._tree_stats.get(provider_id, _EMPTY_STATS)) if is_healthy else 0.0
+            self._tree.update(idx, score)
+
+    async def select_index(self, providers: List[Provider], provider_ids: List[str] = None,
+                           stats: Dict[str, ProviderStats] = None, all_ids: tuple = None,
+                           positions: List[int] = None, failed: List[int] = None,
+                           health_bits: List[bool] = None, **kwargs) -> Optional[int]:
+        """
+        all_ids为完整有序provider ID，positions为各候选provider在其中的下标（升序），
+        failed为本次请求中已失败的provider下标；未提供all_ids时以候选列表本身建树
+        """
         if not providers:
             return None
+        if len(providers) == 1:
+            return 0
 
+        if all_ids is None:
+            if provider_ids is None:
+                provider_ids = [provider.meta().id for provider in providers]
+            all_ids, positions = tuple(provider_ids), None
         if stats is None:
             stats = {}
 
-        # 计算每个provider的综合评分（基础评分 + 基于选择次数的探索奖励）
-        provider_scores = []
-        total_score = 0
-
-        for provider in providers:
-            provider_id = provider.meta().id
-            provider_stat = stats.get(provider_id, {"success": 0, "failure": 0})
-
-            base_score = self.calculate_base_score(provider_stat)
-            total_selections = provider_stat["success"] + provider_stat["failure"]
+        # 有序provider不变时直接复用评分树（评分由回调增量维护），否则重建
+        tree = self._tree
+        if tree is None or (all_ids is not self._tree_ids and all_ids != self._tree_ids):
+            self._rebuild_tree(all_ids, stats, health_bits)
+            tree = self._tree
 
-            # 计算探索奖励：选择次数越少，奖励越高
-            if total_selections > 0:
-                exploration_bonus = self.exploration_factor * math.sqrt(
-                    math.log(total_selections + 1) / total_selections)
-            else:
-                # 从未被选择，给予最大探索奖励
-                exploration_bonus = self.exploration_factor * 10
+        # 本次请求中已失败的provider临时置0，选择后恢复；期间没有await，不影响其他并发请求
+        restore = [(idx, tree.update(idx, 0.0)) for idx in failed] if failed else ()
 
-            # 综合评分 = 基础评分 + 探索奖励
-            score = base_score + exploration_bonus
-            provider_scores.append((provider, score))
-            total_score += score
+        # 加权随机选择：在评分树上按累计评分定位
+        total_score = tree.total()
+        selected = tree.find(random.random() * total_score) if total_score > 0 else None
+        for idx, score in restore:
+            tree.update(idx, score)
 
-        # 加权随机选择
-        if total_score > 0:
-            random_score = random.uniform(0, total_score)
-            current_score = 0
+        if selected is not None:
+            if positions is None:
+                return selected
+            pos = bisect_left(positions, selected)
+            if pos < len(positions) and positions[pos] == selected:
+                return pos
 
-            for provider, score in provider_scores:
-                current_score += score
-                if random_score <= current_score:
-                    return provider
-
-        # 如果所有评分都为0，随机选择
-        return random.choice(providers)
+        # 所有评分都为0，或选中的provider不在本次候选中（如请求期间恢复健康），随机选择
+        return random.randrange(len(providers))
 
 
 class RoundRobinStrategy(LoadBalanceStrategy):
@@ -79,95 +232,92 @@ class RoundRobinStrategy(LoadBalanceStrategy):
 
     def __init__(self, provider_manager):
         super().__init__(provider_manager)
-        self._lock = asyncio.Lock()
         self.current_index = 0
 
-    async def select_provider(self, providers: List[Provider], **kwargs) -> Optional[Provider]:
+    async def select_index(self, providers: List[Provider], **kwargs) -> Optional[int]:
         if not providers:
             return None
-        async with self._lock:
-            provider = providers[self.current_index % len(providers)]
-            self.current_index = (self.current_index + 1) % len(providers)
-        return provider
+        if len(providers) == 1:
+            return 0
+        # 读取与更新之间没有await，单事件循环内不会被其他协程打断，无需加锁
+        i = self.current_index % len(providers)
+        self.current_index = (i + 1) % len(providers)
+        return i
 
 
 class RandomStrategy(LoadBalanceStrategy):
     """随机策略"""
 
-    async def select_provider(self, providers: List[Provider], **kwargs) -> Optional[Provider]:
+    async def select_index(self, providers: List[Provider], **kwargs) -> Optional[int]:
         if not providers:
             return None
-        return random.choice(providers)
+        if len(providers) == 1:
+            return 0
+        return random.randrange(len(providers))
 
 
 class WeightedStrategy(LoadBalanceStrategy):
-    """加权策略"""
+    """加权策略（平滑加权轮询，同Nginx smooth weighted round-robin）"""
 
     def __init__(self, provider_manager):
         super().__init__(provider_manager)
         self.failback_strategy = RoundRobinStrategy(provider_manager)
+        # provider_id -> 当前权重；按ID保存，故障转移时候选子集变化不会重置已有状态
+        self._current_weights: Dict[str, int] = {}
 
-    async def select_provider(self, providers: List[Provider], weights: Dict[str, Any] = None, **kwargs) -> Optional[
-        Provider]:
+    async def select_index(self, providers: List[Provider], provider_ids: List[str] = None,
+                           weights: Dict[str, int] = None, **kwargs) -> Optional[int]:
         if not providers:
             return None
+        if len(providers) == 1:
+            return 0
 
         if not weights:
-            return await self.failback_strategy.select_provider(providers)
-
-        # 构建权重区间
-        weighted_list = []
-        total_weight = 0
-
-        for provider in providers:
-            provider_weight_config = None
-            provider_id = provider.meta().id
-            for weight_config in weights.values():
-                if isinstance(weight_config, dict) and weight_config.get("provider") == provider_id:
-                    provider_weight_config = weight_config
-                    break
-
-            weight = 1  # 默认权重
-            if provider_weight_config:
-                try:
-                    weight = int(provider_weight_config.get("weight", 1))
-                except (ValueError, TypeError):
-                    weight = 1
+            return await self.failback_strategy.select_index(providers)
 
-            if weight > 0:
-                total_weight += weight
-                weighted_list.append((provider, total_weight))
+        if provider_ids is None:
+            provider_ids = [provider.meta().id for provider in providers]
 
-        if total_weight == 0:
-            return await self.failback_strategy.select_provider(providers)
+        # 计算期间没有await，单事件循环内不会被其他协程打断，无需加锁
+        current_weights = self._current_weights
+        selected, selected_id, selected_weight = None, None, 0
+        total_weight = 0
 
-        # 随机选择一个权重点
-        random_weight = random.randint(0, total_weight - 1)
+        # 每个provider的当前权重加上其有效权重，选出当前权重最大者
+        for idx, provider_id in enumerate(provider_ids):
+            weight = weights.get(provider_id, DEFAULT_WEIGHT)
+            if weight <= 0:
+                continue
+            current = current_weights.get(provider_id, 0) + weight
+            current_weights[provider_id] = current
+            total_weight += weight
+            if selected is None or current > selected_weight:
+                selected, selected_id, selected_weight = idx, provider_id, current
 
-        # 遍历查找对应的provider
-        for provider, end_weight in weighted_list:
-            if random_weight < end_weight:
-                return provider
+        # 被选中者的当前权重减去总权重
+        if selected is not None:
+            current_weights[selected_id] -= total_weight
 
-        # 理论上不应该到达这里，但作为兜底
-        return await self.failback_strategy.select_provider(providers)
+        if selected is None:
+            return await self.failback_strategy.select_index(providers)
+        return selected
 
 
 class FastestStrategy(ExplorationStrategy):
     """最快响应策略（基于吞吐量和选择次数）"""
 
-    def calculate_base_score(self, provider_stat: dict) -> float:
+    def calculate_base_score(self, provider_stat: ProviderStats) -> float:
         """基于吞吐量计算基础评分"""
-        return provider_stat.get("throughput", 0)
+        return provider_stat.throughput
 
 
 class LeastFailureStrategy(ExplorationStrategy):
     """最少失败策略（结合成功率和选择次数）"""
 
-    def calculate_base_score(self, provider_stat: dict) -> float:
+    def calculate_base_score(self, provider_stat: ProviderStats) -> float:
         """基于成功率计算基础评分"""
-        success_count = provider_stat.get("success", 0)
-        failure_count = provider_stat.get("failure", 0)
+        success_count = provider_stat.success
+        failure_count = provider_stat.failure
         total_requests = success_count + failure_count
 
         if total_requests > 0:
@@ -175,3 +325,56 @@ class LeastFailureStrategy(ExplorationStrategy):
         else:
             # 未被选择过的provider，给予高成功率评分以鼓励探索
             return 1.0
+
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    """Jump Consistent Hash（Lamping & Veach），将64位key映射到 [0, num_buckets) 的桶"""
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+class ConsistentHashStrategy(LoadBalanceStrategy):
+    """一致性哈希策略（同一会话固定路由到同一provider，便于利用上游的提示词缓存）"""
+
+    def __init__(self, provider_manager):
+        super().__init__(provider_manager)
+        self.failback_strategy = RoundRobinStrategy(provider_manager)
+
+    async def select_index(self, providers: List[Provider], session_id: str = None, **kwargs) -> Optional[int]:
+        if not providers:
+            return None
+        if len(providers) == 1:
+            return 0
+
+        # 没有会话ID时无法保持粘性，退回轮询
+        if not session_id:
+            return await self.failback_strategy.select_index(providers)
+
+        # 使用稳定哈希（内置hash对字符串有进程级随机化，重启后会改变路由）
+        key = int.from_bytes(hashlib.blake2b(session_id.encode(), digest_size=8).digest(), "big")
+        return jump_consistent_hash(key, len(providers))
+
+
+class PowerOfTwoStrategy(LoadBalanceStrategy):
+    """二选一策略（Power of Two Choices）：随机抽取两个provider，选择进行中请求较少的一个"""
+
+    async def select_index(self, providers: List[Provider], provider_ids: List[str] = None,
+                           stats: Dict[str, ProviderStats] = None, **kwargs) -> Optional[int]:
+        if not providers:
+            return None
+        if len(providers) < 2:
+            return 0
+
+        if provider_ids is None:
+            provider_ids = [provider.meta().id for provider in providers]
+        if stats is None:
+            stats = {}
+
+        first, second = random.sample(range(len(providers)), 2)
+        first_inflight = stats.get(provider_ids[first], _EMPTY_STATS).inflight
+        second_inflight = stats.get(provider_ids[second], _EMPTY_STATS).inflight
+        return second if second_inflight < first_inflight else first